@@ -1,7 +1,19 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import email.message
+import hmac
+import sys
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.openapi.constants import REF_PREFIX
+from fastapi.openapi.utils import validation_error_definition, validation_error_response_definition
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from pydantic_core import PydanticCustomError
+from typing import Any, Optional, TypeVar, TypedDict
 
 # hashlib や bcrypt などのハッシュ化ライブラリは、要件に合わせて今回は使用しない
 # import secrets # 今回の要件では不要
@@ -9,13 +21,31 @@ from typing import Optional
 app = FastAPI(
     title="JHC35_FJJ ヘルスケア事業本部 アカウント認証型APIサーバ", # 問題文のタイトルに合わせる
     description="アカウント認証型APIサーバーの実装課題。", # 問題文に合わせて説明を更新
+    default_response_class=ORJSONResponse, # 標準のjsonより高速なorjsonでレスポンスをシリアライズ
 )
 
+# クライアントが gzip に対応していれば 256 バイト以上のレスポンスを圧縮する
+app.add_middleware(GZipMiddleware, minimum_size=256)
+
 security = HTTPBasic()
 
+# users_db に保存するユーザー情報
+class UserRecord(TypedDict):
+    password: str
+    nickname: str
+    comment: Optional[str]
+
+# UserRecord の部分更新用 (全項目が任意。PATCH では nickname と comment のみ設定する)
+class UserRecordUpdate(TypedDict, total=False):
+    password: str
+    nickname: str
+    comment: Optional[str]
+
 # ダミーのユーザーデータベース (実際はDBを使う)
+# プロセス内のdictなので再起動で消え、複数ワーカー・複数レプリカ間でも共有されない。
+# WORKERS や numReplicas を増やす場合は、Redis などの共有ストアに置き換えること
 # 要件に合わせてテストアカウントとパスワードを直接設定
-users_db = {
+users_db: dict[str, UserRecord] = {
     # 予約されたテストアカウント
     "TaroYamada": {
         "password": "PaSSwd4TY", # 要件に合わせてパスワードを平文で保存 (※本番環境では絶対にNG！)
@@ -30,14 +60,20 @@ users_db = {
     },
 }
 
+# 存在しないユーザーの認証時に比較対象として使うダミーパスワード (パスワードの最大長と同じ20文字)
+DUMMY_PW = "x" * 20
+
 # --- モデル定義 ---
 class SignupRequest(BaseModel):
+    # pattern は pydantic-core がスキーマ構築時に一度だけコンパイルし、Rust側で照合する
     # user_idのpatternに'_'は要件にないが、もし必要なら含める
     user_id: str = Field(..., min_length=6, max_length=20, pattern=r"^[a-zA-Z0-9]+$") # 要件は半角英数字のみ
     # passwordのpatternも要件は半角英数字記号 (空白と制御コードを除くASCII文字) なので、現状の[!-~]でOK
-    password: str = Field(..., min_length=8, max_length=20, pattern=r"^[!-~]+$") 
+    password: str = Field(..., min_length=8, max_length=20, pattern=r"^[!-~]+$")
 
-class UserResponse(BaseModel):
+# レスポンス専用のため検証は不要。slots付きdataclassにしてインスタンス生成を軽くし、orjsonで直接シリアライズする
+@dataclass(slots=True)
+class UserResponse:
     user_id: str
     nickname: str
     comment: Optional[str] = None # comment は Optional に
@@ -46,131 +82,220 @@ class UserUpdateRequest(BaseModel):
     nickname: Optional[str] = Field(None, max_length=30)
     comment: Optional[str] = Field(None, max_length=100)
 
-    # 少なくともどちらか一方が指定されていることをバリデーション
-    # Pydantic v2.x: @model_validator(mode='after') を使うか、__init__をオーバーライドする方法も
-    # 今回は簡易的にメソッドとして定義
-    def check_at_least_one_field(self):
+    # 少なくともどちらか一方が指定されていることをボディの検証時にチェックする
+    @model_validator(mode="after")
+    def _check_at_least_one_field(self) -> "UserUpdateRequest":
         if self.nickname is None and self.comment is None:
-            raise ValueError("nickname または comment のどちらか一方は必須です")
+            raise PydanticCustomError("at_least_one_field", "nickname または comment のどちらか一方は必須です")
         return self
 
+# --- エラーレスポンス ---
+
+# よく発生するエラーの detail と headers は読み込み時に一度だけ生成し、リクエストごとの dict 生成を省く
+# HTTPException 自体は traceback (パスワードを含むローカル変数) を保持するため、raise のたびに新しく生成する
+_AUTH_FAILED_DETAIL = "Authentication failed"
+_AUTH_FAILED_HEADERS = {"WWW-Authenticate": "Basic"}
+_USER_ID_ALREADY_USED_DETAIL = {"message": "Account creation failed", "cause": "Already same user_id is used"}
+_USER_NOT_FOUND_DETAIL = {"message": "No user found"}
+_NO_UPDATE_PERMISSION_DETAIL = {"message": "No permission for update"}
+_UPDATE_USER_NOT_FOUND_DETAIL = {"message": "No User found"}
+_CLOSE_USER_NOT_FOUND_DETAIL = {"message": "No user found to remove."}
+
 # --- ヘルパー関数 ---
 
 # 認証処理
-def authenticate_user(credentials: HTTPBasicCredentials = Depends(security)):
+# dictの参照と比較だけでブロッキング処理を含まないため async にし、スレッドプールを経由せずに実行する
+# (bcrypt 等の重いハッシュ処理を追加する場合は asyncio.to_thread で実行すること)
+async def authenticate_user(credentials: HTTPBasicCredentials = Depends(security)) -> str:
     current_user_id = credentials.username
     current_password = credentials.password
 
-    if current_user_id not in users_db:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authentication failed",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    
-    if current_password != users_db[current_user_id]["password"]:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authentication failed",
-            headers={"WWW-Authenticate": "Basic"},
+    # 文字列の != は最初の不一致で打ち切られ処理時間から一致部分が推測できるため、
+    # hmac.compare_digest で全長を比較する。
+    # ユーザーが存在しない場合もダミーのパスワードと比較し、
+    # 「ユーザーなし」と「パスワード誤り」で処理の流れを変えない
+    user_data = users_db.get(current_user_id)
+    stored_pw = user_data["password"] if user_data is not None else DUMMY_PW
+    ok = hmac.compare_digest(current_password.encode(), stored_pw.encode()) and user_data is not None
+    if not ok:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail=_AUTH_FAILED_DETAIL, headers=_AUTH_FAILED_HEADERS)
+
+    # 認証済みのuser_idは intern して返し、同じユーザーのリクエスト間で同じ文字列オブジェクトを使う
+    # (Python 3.12 では intern した文字列は解放されないため、パスワード照合に成功したIDに限定する)
+    return sys.intern(current_user_id)
+
+# リクエストボディの読み込み
+# FastAPI標準の json.loads -> dict -> モデル検証 を行わず、生のボディを pydantic-core で一度に解析・検証する
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# FastAPI標準と同じく、Content-Type が未指定か application/json・application/*+json の場合だけJSONとして扱う
+# (text/plain などをJSONとして受け付けると、CORSのプリフライトなしでクロスサイトから送信できてしまう)
+def _is_json_content_type(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return True
+    message = email.message.Message()
+    message["content-type"] = content_type
+    if message.get_content_maintype() != "application":
+        return False
+    subtype = message.get_content_subtype()
+    return subtype == "json" or subtype.endswith("+json")
+
+async def _validate_json_body(model: type[ModelT], request: Request) -> ModelT:
+    body = await request.body()
+    try:
+        if not _is_json_content_type(request.headers.get("content-type")):
+            # JSON以外はFastAPI標準と同様、bytesのまま from_attributes=True で検証して 422 (model_attributes_type) にする
+            return model.model_validate(body, from_attributes=True)
+        return model.model_validate_json(body)
+    except ValidationError as e:
+        # FastAPI標準と同じ 422 のレスポンスになるよう loc に "body" を付けて変換する
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)],
+            body=body,
         )
-    
-    return credentials.username
+
+# ボディを依存関数で読み込むエンドポイント用に、OpenAPIのリクエストボディのスキーマを作る
+# ※ スキーマはそのまま埋め込むため、入れ子のモデルを持つと "#/$defs/..." の参照が解決できなくなる。
+#    入れ子のモデルを追加する場合は components に登録する形に変更すること
+def _json_body_openapi(model: type[BaseModel]) -> dict[str, Any]:
+    return {
+        "requestBody": {
+            "content": {"application/json": {"schema": model.model_json_schema()}},
+            "required": True,
+        }
+    }
+
+async def parse_signup(request: Request) -> SignupRequest:
+    return await _validate_json_body(SignupRequest, request)
+
+async def parse_user_update(request: Request) -> UserUpdateRequest:
+    return await _validate_json_body(UserUpdateRequest, request)
+
+# --- 例外ハンドラ ---
+
+# UserUpdateRequest で nickname と comment がどちらも未指定の場合は、仕様どおり 400 で返す
+# それ以外の検証エラーは FastAPI 標準の 422 のまま
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError) -> Response:
+    for error in exc.errors():
+        if error["type"] == "at_least_one_field":
+            return ORJSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"detail": {"message": "Update failed", "cause": error["msg"]}},
+            )
+    return await request_validation_exception_handler(request, exc)
 
 # --- エンドポイントの実装 ---
 
-@app.post("/signup", summary="ユーザーアカウントの作成")
-async def signup(request: SignupRequest):
-    if request.user_id in users_db:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"message": "Account creation failed", "cause": "Already same user_id is used"}
-        )
-    
-    users_db[request.user_id] = {
+@app.post(
+    "/signup",
+    summary="ユーザーアカウントの作成",
+    # ボディの検証エラーは _validate_json_body が 422 で返すため、ドキュメントにも記載する
+    # (参照先の HTTPValidationError は下の _openapi_with_validation_error で components に登録する)
+    responses={
+        422: {
+            "description": "Validation Error",
+            "content": {"application/json": {"schema": {"$ref": REF_PREFIX + "HTTPValidationError"}}},
+        }
+    },
+    openapi_extra=_json_body_openapi(SignupRequest),
+)
+async def signup(request: SignupRequest = Depends(parse_signup)) -> ORJSONResponse:
+    user_id = request.user_id
+    new_user: UserRecord = {
         "password": request.password,
-        "nickname": request.user_id, # 初期値はuser_id
+        "nickname": user_id, # 初期値はuser_id
         "comment": None # 初期値はNone
     }
-    return {
+    # 存在チェックと登録を setdefault の1回の操作で行う (既存ユーザーがいれば既存の値が返る)
+    if users_db.setdefault(user_id, new_user) is not new_user:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=_USER_ID_ALREADY_USED_DETAIL)
+
+    # 値はすべて str/None なので、jsonable_encoder を通さず ORJSONResponse で直接返す
+    return ORJSONResponse({
         "message": "Account successfully created",
         "user": {
-            "user_id": request.user_id,
-            "nickname": request.user_id
+            "user_id": user_id,
+            "nickname": user_id
         }
-    }
+    })
 
-@app.get("/users/{user_id}", response_model=UserResponse, summary="ユーザー情報の取得")
-async def get_user_info(user_id: str, authenticated_user: str = Depends(authenticate_user)):
+# response_model を指定すると信頼できる users_db のデータを再度検証してしまうため、
+# スキーマは responses でドキュメントにのみ記載し、UserResponse を ORJSONResponse で直接返す
+@app.get("/users/{user_id}", responses={200: {"model": UserResponse}}, summary="ユーザー情報の取得")
+async def get_user_info(user_id: str, authenticated_user: str = Depends(authenticate_user)) -> ORJSONResponse:
     user_data = users_db.get(user_id)
     if not user_data:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"message": "No user found"})
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=_USER_NOT_FOUND_DETAIL)
     
     # 仕様に合わせて nickname が未設定の場合は user_id と同じ値を返す
     # 今回のusers_db初期値とsignupロジックでは自動的に user_id と同じになる
     returned_nickname = user_data.get("nickname", user_id) 
     
-    return UserResponse(user_id=user_id, nickname=returned_nickname, comment=user_data.get("comment"))
+    return ORJSONResponse(UserResponse(user_id=user_id, nickname=returned_nickname, comment=user_data.get("comment")))
 
 
 # パスパラメータ名を userid から user_id に修正して統一
-@app.patch("/users/{user_id}", response_model=UserResponse, summary="ユーザー情報の更新")
+@app.patch("/users/{user_id}", summary="ユーザー情報の更新", openapi_extra=_json_body_openapi(UserUpdateRequest))
 async def update_user_info(
     user_id: str,
-    update_request: UserUpdateRequest, # 変数名を update_request に変更して衝突を避ける
-    authenticated_user: str = Depends(authenticate_user)
-):
-    if user_id != authenticated_user:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail={"message": "No permission for update"})
-
-    if user_id not in users_db:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"message": "No User found"})
-
-    # リクエストボディのバリデーションはPydanticモデルが自動で行うため、ValueErrorを捕捉
-    try:
-        update_request.check_at_least_one_field() # update_request のメソッドを呼び出す
-    except ValueError as e:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"message": "Update failed", "cause": str(e)})
+    # 依存関数は引数の順に実行されるため、従来どおり認証をボディの検証より先に行う
+    authenticated_user: str = Depends(authenticate_user),
+    update_request: UserUpdateRequest = Depends(parse_user_update), # 変数名を update_request に変更して衝突を避ける
+) -> ORJSONResponse:
+    # パスワードと同様に、短絡しない hmac.compare_digest で比較する (パスパラメータは非ASCIIもあり得るためbytesで比較)
+    if not hmac.compare_digest(user_id.encode(), authenticated_user.encode()):
+        raise HTTPException(status.HTTP_403_FORBIDDEN, detail=_NO_UPDATE_PERMISSION_DETAIL)
 
-    current_user_data = users_db[user_id]
+    # 以降は authenticated_user (= user_id) をキーに使う
+    current_user_data = users_db.get(authenticated_user)
+    if current_user_data is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=_UPDATE_USER_NOT_FOUND_DETAIL)
 
-    # nickname と comment の更新
+    # 指定された (Noneでない) 項目だけをまとめて1回の update で反映する
+    # 長さの上限と「どちらか一方は必須」は UserUpdateRequest の検証でチェック済み
+    updates: UserRecordUpdate = {}
     if update_request.nickname is not None:
-        # PydanticのFieldでmax_lengthを指定しているので、ここでは明示的な長さチェックは不要だが、
-        # 問題の仕様に厳密に合わせるなら以下のように記述
-        # if not (1 <= len(update_request.nickname) <= 30):
-        #      raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"message": "User update failed", "cause": "Invalid nickname length."})
-        current_user_data["nickname"] = update_request.nickname
-    
+        updates["nickname"] = update_request.nickname
     if update_request.comment is not None:
-        # PydanticのFieldでmax_lengthを指定しているので、ここでは明示的な長さチェックは不要だが、
-        # 問題の仕様に厳密に合わせるなら以下のように記述 (コメントは0文字も許容される場合)
-        # if not (0 <= len(update_request.comment) <= 100):
-        #     raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"message": "User update failed", "cause": "Invalid comment length."})
-        current_user_data["comment"] = update_request.comment
-    
-    users_db[user_id] = current_user_data # 更新を反映
+        updates["comment"] = update_request.comment
+    # current_user_data は users_db 内の dict そのものなので、書き戻しは不要
+    current_user_data.update(updates)
 
-    return {
+    return ORJSONResponse({
         "message": "User successfully updated.",
-        "user": {
-            "user_id": user_id,
-            "nickname": current_user_data["nickname"],
-            "comment": current_user_data.get("comment"),
-        }
-    }
+        "user": UserResponse(
+            user_id=user_id,
+            nickname=current_user_data["nickname"],
+            comment=current_user_data.get("comment"),
+        ),
+    })
 
 @app.post("/close", summary="アカウントの削除")
-async def close_account(authenticated_user: str = Depends(authenticate_user)):
+async def close_account(authenticated_user: str = Depends(authenticate_user)) -> ORJSONResponse:
     # ユーザーが存在する場合に削除
     if authenticated_user in users_db: 
         del users_db[authenticated_user]
-        return {"message": "Account and user successfully removed."}
+        return ORJSONResponse({"message": "Account and user successfully removed."})
     else: # 認証済みだがユーザーが見つからない（通常ありえないケース）
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail={"message": "No user found to remove."},
-        )
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=_CLOSE_USER_NOT_FOUND_DETAIL)
+
+# --- OpenAPI ---
+
+# FastAPI は自動で 422 を付けたルートがある場合にしか ValidationError / HTTPValidationError を components に登録しない。
+# /signup の 422 が参照するスキーマが他のルートの有無に左右されないよう、常に登録する
+_default_openapi = app.openapi
+
+def _openapi_with_validation_error() -> dict[str, Any]:
+    if app.openapi_schema is not None:
+        return app.openapi_schema
+    schema = _default_openapi() # 生成したスキーマは app.openapi_schema にも保持される
+    schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+    schemas.setdefault("ValidationError", validation_error_definition)
+    schemas.setdefault("HTTPValidationError", validation_error_response_definition)
+    return schema
+
+app.openapi = _openapi_with_validation_error  # type: ignore[method-assign]
 
 # --- 開発用の実行コマンド ---
 if __name__ == "__main__":
@@ -179,4 +304,8 @@ if __name__ == "__main__":
     
     # 環境変数PORTが設定されていればそれを使用、なければ8000
     port = int(os.environ.get("PORT", 8000)) 
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # 環境変数WORKERSでワーカープロセス数を指定 (未設定ならuvicornがWEB_CONCURRENCYを参照し、それもなければ1)
+    # ※ users_db はプロセスごとに別々のため、複数ワーカーでは登録・更新内容がワーカー間で共有されない点に注意
+    workers = int(os.environ.get("WORKERS", 0)) or None
+    # イベントループに uvloop、HTTPパーサに httptools (いずれも requirements.txt に記載済み) を使う
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools")